@@ -45,9 +45,14 @@ class Trajectory(object):
         - num_steps:
         - timestep:
         - atoms:
+        - scratch:   optional filename prefix. If given, the positions and
+                     forces arrays are backed by numpy memmaps at
+                     <scratch>.pos.npy and <scratch>.forces.npy instead of
+                     being held in RAM, so very long runs are paged to disk
+                     as they are filled in.
     """
 
-    def __init__(self, filename = '', num_steps = 0, timestep = 1., atoms = []):
+    def __init__(self, filename = '', num_steps = 0, timestep = 1., atoms = [], scratch = None):
         self.filename = filename
         self.path = ''
         self.pbc_unwrapped = False
@@ -64,8 +69,19 @@ class Trajectory(object):
             self.basis = np.zeros((self.length,3,3))
             self.total_energy = np.zeros(self.length)
             self.kinetic_energy = np.zeros(self.length)
-            self._positions = np.zeros((num_steps, self.num_atoms, 3))
-            self._forces = np.zeros((num_steps, self.num_atoms, 3))
+            # Positions and forces dominate the memory footprint, so they
+            # are stored as float32 (VASP prints far fewer significant
+            # digits than float32 holds) and optionally as disk-backed
+            # memmaps, which turns the fill-in into sequential disk writes.
+            shape = (num_steps, self.num_atoms, 3)
+            if scratch is None:
+                self._positions = np.zeros(shape, dtype=np.float32)
+                self._forces = np.zeros(shape, dtype=np.float32)
+            else:
+                self._positions = np.lib.format.open_memmap(scratch + '.pos.npy',
+                        mode='w+', dtype=np.float32, shape=shape)
+                self._forces = np.lib.format.open_memmap(scratch + '.forces.npy',
+                        mode='w+', dtype=np.float32, shape=shape)
             self.set_timestep(timestep)
             #print "Allocated %.2f MB for Trajectory object" % ((self._time.nbytes + self.total_energy.nbytes + self.kinetic_energy.nbytes + self._positions.nbytes + self._forces.nbytes)/(1024.**2))
         # Set default selection to the whole trajectory:
@@ -41,10 +41,15 @@ class KTest(BatchJob):
         plines = f.readlines()
         f.close()
 
+        # Join the unchanged parts of KPOINTS once, so each output file
+        # can be written with a single write() call instead of one
+        # write per line.
+        head = ''.join(plines[0:3])
+        tail = ''.join(plines[4:])
+
         for i in range(len(param_values)):
-            plines[3] = param_values[i] + '\n'
             ifile = open('KPOINTS.%d' % (i), 'w')
-            ifile.writelines(plines)
+            ifile.write('%s%s\n%s' % (head, param_values[i], tail))
             ifile.close()
             self.addStep(KTestStep(i,param_values[i]))
 
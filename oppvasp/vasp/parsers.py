@@ -15,7 +15,7 @@ Note that this file contains code originally written by olem
 
 from copy import copy
 import sys,re,math,os
-from StringIO import StringIO
+import mmap
 import numpy as np
 
 import oppvasp
@@ -48,34 +48,176 @@ try:
 except ImportError:
     print "Info: Module 'psutil' is not available"
 
+# Read buffer size used when opening input files. The Python default of
+# 8 kB means tens of thousands of read() syscalls for an MD-sized file;
+# 1 MiB cuts that proportionally.
+_BUF = 1 << 20
+
+# Control characters that invalidate the xml. Compiled once at module
+# level so per-read calls skip the regex-cache lookup.
+_XML_BAD_CHARS = re.compile(b'[\x00-\x09\x0B-\x1F]')
+
 def ZapControlCharacters(filename):
     print "Document contains control characters that break the parser!"
     print "Trying to zap them... (this may take some time)"
-    doc = open(filename).read()
+    doc = open(filename,'rb').read()
     # zap control characters that invalidates the xml
-    doc = re.sub('[\x00-\x09\x0B-\x1F]','',doc)
-    f = file(filename,'w')
+    doc = _XML_BAD_CHARS.sub(b'',doc)
+    f = file(filename,'wb')
     f.write(doc)
     f.close()
 
 
 class myFile(object):
     def __init__(self, filename):
-        self.f = open(filename)
+        self.f = open(filename,'rb',_BUF)
 
-    def read(self, size=None):
+    def read(self, size = -1):
+        if size is None or size < 0:
+            line = self.f.readline()
+        else:
+            line = self.f.readline(size)
+        if not line:
+            # signal EOF like a normal file object, instead of letting a
+            # StopIteration from next() propagate through the C parser
+            return b''
         # zap control characters that invalidates the xml
-        #return self.f.next().replace('\x1e', '').replace('some other bad character...' ,'')
-        return re.sub('[\x00-\x09\x0B-\x1F]','',self.f.next())
+        return _XML_BAD_CHARS.sub(b'',line)
 
 
 
+# get_atomic_number_from_symbol scans the whole element table on every
+# call. The atom list in vasprun.xml holds one entry per atom but only a
+# handful of unique species, so the lookups are cached here.
+_atomic_number_cache = {}
+
+def _cached_atomic_number(symbol):
+    try:
+        return _atomic_number_cache[symbol]
+    except KeyError:
+        z = get_atomic_number_from_symbol(symbol)
+        _atomic_number_cache[symbol] = z
+        return z
+
+def parse_vector_nodes(nodes):
+    """
+    Parses a list of <v> elements into a (n,3) numpy array, or None if
+    the list is empty. The text of all nodes is joined and handed to
+    numpy in one go, which is much faster than looping over the nodes
+    in Python and calling float() on each component.
+    """
+    if not nodes:
+        return None
+    return np.fromstring(' '.join(n.text for n in nodes), sep=' ').reshape(len(nodes), 3)
+
 def print_memory_usage():
     if imported['psutil']:
         p = psutil.Process(os.getpid())
         rss,vms = p.get_memory_info()
         print "[current physical memory usage: %.1f MB]" % (rss/1024.**2)
 
+class _TrajectoryTarget(object):
+    """
+    lxml parser target that collects trajectory data for
+    IterativeVasprunParser. The interesting character data is captured
+    directly from the parser events and committed to the Trajectory one
+    ionic step at a time, so no xml elements are ever allocated. For MD
+    runs with many <v> tags per step this is the dominant saving over
+    event-based (iterparse) parsing.
+    """
+
+    # varrays to collect, identified by their name attribute and their
+    # tag path below <calculation>
+    _wanted_varrays = {
+        ('structure', 'crystal', 'varray') : 'basis',
+        ('structure', 'varray') : 'positions',
+        ('varray',) : 'forces',
+    }
+
+    def __init__(self, vasprun):
+        self.vasprun = vasprun
+        self.path = []
+        self.collecting = False
+        self.textbuf = []
+        self.varray_name = None
+        self.vbuf = None
+        self.energy_name = None
+        self.stepdata = {}
+
+    def start(self, tag, attrib):
+        path = self.path
+        path.append(tag)
+        if len(path) < 3 or path[1] != 'calculation':
+            return
+        if tag == 'v':
+            if self.varray_name is not None:
+                self.collecting = True
+                self.textbuf = []
+        elif tag == 'varray':
+            if self._wanted_varrays.get(tuple(path[2:])) == attrib.get('name'):
+                self.varray_name = attrib.get('name')
+                self.vbuf = []
+        elif tag == 'i' and tuple(path[2:]) == ('energy', 'i'):
+            if attrib.get('name') in ('kinetic', 'e_fr_energy'):
+                self.energy_name = attrib.get('name')
+                self.collecting = True
+                self.textbuf = []
+
+    def data(self, data):
+        if self.collecting:
+            self.textbuf.append(data)
+
+    def end(self, tag):
+        path = self.path
+        in_calculation = len(path) > 1 and path[1] == 'calculation'
+        path.pop()
+        if not in_calculation:
+            return
+        if tag == 'v':
+            if self.collecting:
+                self.vbuf.append(''.join(self.textbuf))
+                self.collecting = False
+        elif tag == 'varray':
+            if self.varray_name is not None:
+                arr = np.fromstring(' '.join(self.vbuf), sep=' ')
+                self.stepdata[self.varray_name] = arr.reshape(-1, 3)
+                self.varray_name = None
+                self.vbuf = None
+        elif tag == 'i':
+            if self.collecting:
+                self.stepdata[self.energy_name] = float(''.join(self.textbuf))
+                self.collecting = False
+                self.energy_name = None
+        elif tag == 'calculation':
+            self._commit_step()
+
+    def _commit_step(self):
+        """ Pushes the data collected for one ionic step into the Trajectory """
+        vp = self.vasprun
+        traj = vp.trajectory
+        step = self.stepdata
+        if 'basis' in step:
+            traj.set_basis(vp.step_no, step['basis'])
+        for key, setter in (('positions', traj.set_positions), ('forces', traj.set_forces)):
+            if key in step:
+                arr = step[key]
+                if traj.num_atoms == 1 and arr.shape[0] > 1:
+                    # single-atom trajectory: keep only the requested atom
+                    arr = arr[vp.atom_no].reshape(1,3)
+                setter(vp.step_no, arr)
+        if 'kinetic' in step:
+            traj.set_e_kinetic(vp.step_no, step['kinetic'])
+        if 'e_fr_energy' in step:
+            traj.set_e_total(vp.step_no, step['e_fr_energy'])
+        vp.step_no += 1
+        if imported['progressbar']:
+            vp.pbar.update(vp.step_no)
+        self.stepdata = {}
+
+    def close(self):
+        self.path = []
+
+
 class IterativeVasprunParser(object):
     """
     Parser for very large vasprun.xml files, based on iterative xml parsing.
@@ -99,9 +241,40 @@ class IterativeVasprunParser(object):
             sys.exit(1)
 
         #print_memory_usage()
-        
-        # read beginning of file to find number of ionic steps (NSW) and timestep (POTIM)
-        self.params = self._find_first_instance('parameters', self._params_tag_found)
+
+        # Read the beginning of the file to find the ionic step count
+        # (NSW), the timestep (POTIM), the atom list and the initial
+        # structure. All the header tags are collected in a single
+        # iterparse pass, instead of re-reading the file from the start
+        # once per tag.
+        self.params = None
+        self.atoms = None
+        self._initial_structure = None
+        needed = set(['parameters', 'atominfo', 'structure'])
+        context = etree.iterparse(self.filename, tag = tuple(needed))
+        try:
+            for event, elem in context:
+                if elem.tag == 'parameters':
+                    self.params = copy(elem)
+                elif elem.tag == 'atominfo':
+                    self.atoms = self._get_atoms(elem)
+                elif elem.tag == 'structure' and self._initial_structure is None:
+                    self._initial_structure = self._get_initial_structure(elem)
+                needed.discard(elem.tag)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                if not needed:
+                    break
+        except etree.XMLSyntaxError:
+            self._print_xml_error()
+            sys.exit(1)
+        del context
+
+        if self.params is None:
+            print "Could not find the parameters tag in %s" % (self.filename)
+            sys.exit(1)
+
         self.nsw = int(self.params.xpath("separator[@name='ionic']/i[@name='NSW']")[0].text)
         if self.nsw == 0:
             print "Note: This file contains no ionic motion (NSW=0)."
@@ -110,35 +283,25 @@ class IterativeVasprunParser(object):
         # should make a try clause
         self.potim = float(self.params.xpath("separator[@name='ionic']/i[@name='POTIM']")[0].text)
 
-        self.atoms = self._find_first_instance('atominfo',self._get_atoms)
         self.natoms = len(self.atoms)
 
-        try:
-            self.nsw
-            #print "Number of ionic steps: %d" % (self.nsw) 
-        except AttributeError:
-            print "Could not find incar:NSW in vasprun.xml"
-            sys.exit(1)
+    def _print_xml_error(self):
+        print "XML parsing failed:"
+        type, message, traceback = sys.exc_info()
+        print message
+        if str(message).split()[0] == 'Char':
+            ZapControlCharacters(self.filename)
+            print
+            print "You may now try to re-run the script."
+            print
 
-    def _params_tag_found(self, elem):
-        return copy(elem)
-    
     def _get_atoms(self, elem):
-        atoms = []
-        for rc in elem.xpath("array[@name='atoms']/set/rc"):
-            atoms.append(get_atomic_number_from_symbol(rc[0].text))
-        return np.array(atoms, dtype=int)
-
-    def _fast_iter(self, context, func):
-        for event, elem in context:
-            func(elem)
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
-        del context
+        # np.fromiter fills the array directly from the generator,
+        # without building an intermediate Python list
+        return np.fromiter((_cached_atomic_number(rc[0].text)
+            for rc in elem.xpath("array[@name='atoms']/set/rc")), dtype=int)
 
     def _find_first_instance(self, tag, func):
-        parser = etree.XMLParser()
         context = etree.iterparse(self.filename, tag=tag)
         ret = None
         try:
@@ -149,17 +312,7 @@ class IterativeVasprunParser(object):
                     del elem.getparent()[0]
                 break
         except etree.XMLSyntaxError:
-            print "XML parsing failed:"
-            type, message, traceback = sys.exc_info()
-            print message
-            for e in parser.error_log:
-                print "XML Error: "+e.message
-            if str(message).split()[0] == 'Char':
-                ZapControlCharacters(self.filename)
-                print
-                print "You may now try to re-run the script."
-                print
-
+            self._print_xml_error()
             sys.exit(1)
         del context
         return ret
@@ -177,64 +330,74 @@ class IterativeVasprunParser(object):
         return self.atoms
 
     def _get_initial_structure(self,elem):
-        basis= elem.xpath("crystal/varray[@name='basis']/v")
-        basis = [[float(x) for x in p.text.split()] for p in basis]
-
-        pos = elem.xpath("varray[@name='positions']/v")
-        pos = [[float(x) for x in p.text.split()] for p in pos]
-
-        vel = elem.xpath("varray[@name='velocities']/v")
-        vel = [[float(x) for x in p.text.split()] for p in vel]
+        basis = parse_vector_nodes(elem.xpath("crystal/varray[@name='basis']/v"))
+        pos = parse_vector_nodes(elem.xpath("varray[@name='positions']/v"))
+        vel = parse_vector_nodes(elem.xpath("varray[@name='velocities']/v"))
 
         return { 'basis': basis, 'positions': pos, 'velocities': vel }
 
     def get_initial_structure(self):
         """
-        Returns a dictionary containing 'basis', 'positions' and 'velocities' 
+        Returns a dictionary containing 'basis', 'positions' and 'velocities'
         """
-        return self._find_first_instance('structure',self._get_initial_structure) 
-
-    def _calculation_tag_found(self, elem):
-
-        bas = elem.xpath("structure/crystal/varray[@name='basis']/v")
-        self.trajectory.set_basis(self.step_no, np.array([[float(x) for x in b.text.split()] for b in bas]))
-
-        if self.trajectory.num_atoms == 1:
-            pos = elem.xpath("structure/varray[@name='positions']/v[%d]" % (self.atom_no+1))
-            forces = elem.xpath("structure/varray[@name='forces']/v[%d]" % (self.atom_no+1))
-        else:
-            pos = elem.xpath("structure/varray[@name='positions']/v")
-            forces = elem.xpath("varray[@name='forces']/v")
-        pos = [[float(x) for x in ap.text.split()] for ap in pos]
-        forces = [[float(x) for x in ap.text.split()] for ap in forces]
-        self.trajectory.set_positions(self.step_no, pos)
-        self.trajectory.set_forces(self.step_no, forces)
-        
-        e_kin = elem.xpath("energy/i[@name='kinetic']")
-        if e_kin:
-            self.trajectory.set_e_kinetic(self.step_no, float(e_kin[0].text))
-        
-        e_pot = elem.xpath("energy/i[@name='e_fr_energy']")
-        self.trajectory.set_e_total(self.step_no, float(e_pot[0].text))
-
-        self.step_no += 1
-        if imported['progressbar']:
-            self.pbar.update(self.step_no)
-        #print pos
+        if self._initial_structure is None:
+            # normally collected during __init__; scan again as a fallback
+            self._initial_structure = self._find_first_instance('structure',self._get_initial_structure)
+        return self._initial_structure
 
     def _get_trajectories(self):
         """ Internal method to make a Trajectory object """
         atoms = self.get_atoms()
-        self.trajectory = Trajectory(num_steps = self.nsw, timestep = self.potim, atoms = atoms)
+
+        # Check for a cached copy of the parsed trajectory. The cache is
+        # only used if the mtime and size of the xml file are unchanged,
+        # so re-running an analysis on the same file skips the (slow)
+        # xml parsing completely.
+        cache_file = self.filename + '.traj.npz'
+        cache_key = np.array([os.path.getmtime(self.filename), os.path.getsize(self.filename)])
+        if os.path.isfile(cache_file):
+            try:
+                npz = np.load(cache_file)
+                if 'key' in npz.files and np.all(npz['key'] == cache_key):
+                    print "Using cached trajectory from %s" % (cache_file)
+                    self.trajectory = Trajectory(num_steps = npz['pos'].shape[0], timestep = self.potim, atoms = atoms)
+                    self.trajectory.basis = npz['basis']
+                    self.trajectory.positions = npz['pos']
+                    self.trajectory.forces = npz['forces']
+                    self.trajectory.total_energy = npz['tote']
+                    self.trajectory.kinetic_energy = npz['kine']
+                    return
+                print "Cache file %s is outdated, re-parsing" % (cache_file)
+            except Exception:
+                # a truncated or otherwise corrupt cache must never block
+                # the parser; just fall through to a fresh parse
+                print "Warning: Could not read trajectory cache %s, re-parsing" % (cache_file)
+
+        scratch = self.filename
+        try:
+            self.trajectory = Trajectory(num_steps = self.nsw, timestep = self.potim, atoms = atoms,
+                    scratch = scratch)
+        except (IOError, OSError):
+            # the data directory may not be writable (e.g. archived runs);
+            # fall back to keeping the arrays in memory
+            print "Warning: Could not create scratch files next to %s, keeping trajectory in memory" % (self.filename)
+            for suffix in ('.pos.npy', '.forces.npy'):
+                try:
+                    os.remove(scratch + suffix)
+                except OSError:
+                    pass
+            scratch = None
+            self.trajectory = Trajectory(num_steps = self.nsw, timestep = self.potim, atoms = atoms)
         self.step_no = 0
         status_text = "Parsing %s (%.2f MB)... " % (self.filename, os.path.getsize(self.filename)/1024.**2)
         if imported['progressbar']:
             self.pbar = ProgressBar(widgets=[status_text,Percentage()], maxval = self.nsw+1).start()
         
-        parser = etree.XMLParser()
-        context = etree.iterparse(self.filename, tag='calculation')
+        # Parse with a target object, which receives the parser events
+        # directly and fills the Trajectory without building any elements.
+        parser = etree.XMLParser(target = _TrajectoryTarget(self))
         try:
-            self._fast_iter(context, self._calculation_tag_found)
+            etree.parse(myFile(self.filename), parser)
         except etree.XMLSyntaxError:
             type, message, traceback = sys.exc_info()
             print "XML parsing halted:",message
@@ -245,6 +408,28 @@ class IterativeVasprunParser(object):
             self.pbar.finish()
         print "Found %d out of %d steps" % (self.step_no,self.nsw)
         self.trajectory.update_length(self.step_no)
+
+        # Write to a temporary name and rename into place, so an
+        # interrupted write can never leave a partial file behind that
+        # would later be picked up as a cache.
+        tmp_file = cache_file + '.tmp.npz' # keep the .npz suffix so savez does not append one
+        try:
+            np.savez_compressed(tmp_file, key = cache_key,
+                basis = self.trajectory.basis, pos = self.trajectory.positions,
+                forces = self.trajectory.forces, tote = self.trajectory.total_energy,
+                kine = self.trajectory.kinetic_energy)
+            os.rename(tmp_file, cache_file)
+            if scratch is not None:
+                # the scratch memmaps now just duplicate the cached data;
+                # the mappings held by the Trajectory stay valid after the
+                # files are unlinked
+                for suffix in ('.pos.npy', '.forces.npy'):
+                    try:
+                        os.remove(scratch + suffix)
+                    except OSError:
+                        pass
+        except (IOError, OSError):
+            print "Warning: Could not write trajectory cache to %s" % (cache_file)
         print_memory_usage()
     
     def get_trajectory(self):
@@ -268,9 +453,8 @@ class IterativeVasprunParser(object):
             parser = etree.XMLParser()
             context = etree.iterparse(self.filename, tag='atominfo')
             for event, elem in context:
-                atominfo = []
-                for rc in elem.xpath("array[@name='atoms']/set/rc"):
-                    atominfo.append(get_atomic_number_from_symbol(rc[0].text.strip()))
+                atominfo = [_cached_atomic_number(rc[0].text.strip())
+                    for rc in elem.xpath("array[@name='atoms']/set/rc")]
                 break  # avoid scanning the whole file!
 
             context = etree.iterparse(self.filename, tag='calculation')
@@ -407,18 +591,16 @@ class VasprunParser(object):
             print "Reading %s (%.2f MB)... " % (filename,os.path.getsize(filename)/1024.**2)
 
         self.filename = filename
-        docstr = open(filename).read()
-
-        # zap control characters that invalidates the xml
-        docstr = re.sub('[\x00-\x09\x0B-\x1F]','',docstr)
 
         if verbose:
-            print "Parsing... " 
+            print "Parsing... "
 
-        parser = etree.XMLParser() #recovers from bad characters.
+        # Parse through myFile, which zaps control characters chunk by chunk
+        # as the file is read, instead of reading the whole document into
+        # memory and running a regex over it first.
+        parser = etree.XMLParser(recover = True, huge_tree = True) #recovers from bad characters.
         try:
-            self.doc = etree.parse(StringIO(docstr), parser)
-            #self.doc = etree.parse(self.filename, parser)
+            self.doc = etree.parse(myFile(filename), parser)
             for e in parser.error_log:
                 print "Warning: "+e.message
         except etree.XMLSyntaxError:
@@ -431,11 +613,8 @@ class VasprunParser(object):
     @property
     def ionic_steps(self):
 
-        atoms = []
-        for rc in self.doc.xpath("/modeling/atominfo/array[@name='atoms']/set/rc"):
-            atoms.append(get_atomic_number_from_symbol(rc[0].text.strip()))
-        #atoms = [rc[0].text.strip() for rc in atoms]
-        atoms = np.array(atoms, dtype=int)
+        atoms = np.fromiter((_cached_atomic_number(rc[0].text.strip())
+            for rc in self.doc.xpath("/modeling/atominfo/array[@name='atoms']/set/rc")), dtype=int)
 
         results = self.doc.xpath( "/modeling/calculation")
         if results:
@@ -516,11 +695,7 @@ class VasprunParser(object):
         Returns the final position of all atoms as a (n,3) numpy array, where n is the number of atoms
         """
         all_pos = self.doc.xpath( "/modeling/structure[@name='initialpos']/varray[@name='positions']/v")
-        num_atoms = len(all_pos)
-        pos_array = np.zeros((num_atoms,3))
-        for i in range(num_atoms):
-            pos_array[i] = [float(f) for f in all_pos[i].text.split()]
-        return pos_array
+        return parse_vector_nodes(all_pos)
 
     def get_named_structure(self, name):
         """ Returns a named structure as a oppvasp.Structure object. """
@@ -553,11 +728,8 @@ class VasprunParser(object):
             # Found no forces
             forces = None
 
-        atoms = []
-        for rc in self.doc.xpath("/modeling/atominfo/array[@name='atoms']/set/rc"):
-            atoms.append(get_atomic_number_from_symbol(rc[0].text.strip()))
-        #atoms = [rc[0].text.strip() for rc in atoms]
-        atoms = np.array(atoms, dtype=int)
+        atoms = np.fromiter((_cached_atomic_number(rc[0].text.strip())
+            for rc in self.doc.xpath("/modeling/atominfo/array[@name='atoms']/set/rc")), dtype=int)
 
         return Structure( cell = basis, atomtypes = atoms, positions = pos, velocities = vel, forces = forces, coords = 'direct' )
 
@@ -582,11 +754,7 @@ class VasprunParser(object):
         Returns the final position of all atoms as a (n,3) numpy array, where n is the number of atoms
         """
         all_pos = self.doc.xpath( "/modeling/structure[@name='finalpos']/varray[@name='positions']/v")
-        num_atoms = len(all_pos)
-        pos_array = np.zeros((num_atoms,3))
-        for i in range(num_atoms):
-            pos_array[i] = [float(f) for f in all_pos[i].text.split()]
-        return pos_array
+        return parse_vector_nodes(all_pos)
     
     def get_initial_velocities (self):
         """
@@ -596,11 +764,7 @@ class VasprunParser(object):
         if not all_vel:
             raise LookupError('Velocities not found. Is this file from a MD run?')
 
-        num_atoms = len(all_vel)
-        vel_array = np.zeros((num_atoms,3))
-        for i in range(num_atoms):
-            vel_array[i] = [float(f) for f in all_vel[i].text.split()]
-        return vel_array
+        return parse_vector_nodes(all_vel)
 
     def get_final_velocities(self):
         """
@@ -610,11 +774,7 @@ class VasprunParser(object):
         if not all_vel:
             raise LookupError('Velocities not found. Is this file from a MD run?')
 
-        num_atoms = len(all_vel)
-        vel_array = np.zeros((num_atoms,3))
-        for i in range(num_atoms):
-            vel_array[i] = [float(f) for f in all_vel[i].text.split()]
-        return vel_array
+        return parse_vector_nodes(all_vel)
 
     def get_final_atom_position(self,atom_no):
         """
@@ -624,23 +784,30 @@ class VasprunParser(object):
         atpos = np.array([float(f) for f in pos[atom_no-1].text.split()])
         return atpos
     
+    def _load_all_positions(self):
+        """
+        Returns a (nsteps, natoms, 3) numpy array holding the positions of
+        all atoms at every ionic step. The array is built from a single
+        document-wide xpath call and cached on the instance, so repeated
+        per-atom queries only walk the xml once.
+        """
+        if not hasattr(self, '_positions_all'):
+            natoms = int(self.doc.xpath("/modeling/atominfo/atoms")[0].text)
+            texts = self.doc.xpath(
+                "/modeling/calculation/structure/varray[@name='positions']/v/text()")
+            self._positions_all = np.fromstring(' '.join(texts), sep=' ').reshape(-1, natoms, 3)
+        return self._positions_all
+
     def get_atom_trajectory(self,atom_no):
         """
         Returns a (n,3) numpy array with the position of atom <atom_no> for n timesteps.
         The index of the first atom is 0.
         """
-        steps = self.doc.xpath( "/modeling/calculation" )
-        num_steps = len(steps)
-        traj = np.zeros((num_steps,3))
-        i = 0
-        for step in steps:
-            pos = step.xpath( "structure/varray[@name='positions']/v[%d]" % (atom_no+1) )[0].text.split()
-            traj[i] = [float(p) for p in pos]
-            i += 1
-        
-        print "Found %d steps" % (i)
+        traj = self._load_all_positions()[:,atom_no,:]
+
+        print "Found %d steps" % (traj.shape[0])
 
-        return traj 
+        return traj
 
     def get_final_volume(self):
         """
@@ -657,15 +824,12 @@ class VasprunParser(object):
         Returns the max force acting on any atom
         """
         forces = self.doc.xpath( "/modeling/calculation[last()]/varray[@name='forces']/v")
-        max_force = 0.0
-        max_force_atm = -1
-        for i,f in enumerate(forces):
-            force = np.array([float(n) for n in f.text.split()])
-            force_norm = np.sqrt(np.dot(force,force))
-            if force_norm > max_force:
-                max_force = force_norm
-                max_force_atm = i
-        return (max_force,max_force_atm)
+        arr = parse_vector_nodes(forces)
+        if arr is None:
+            return (0.0, -1)
+        norms = np.sqrt((arr*arr).sum(axis=1))
+        max_force_atm = int(np.argmax(norms))
+        return (float(norms[max_force_atm]), max_force_atm)
 
     def get_time_spent(self):
         """
@@ -701,46 +865,59 @@ class FileIterator(object):
     """
 
 
-    def __init__(self, filename, cache = True):
+    def __init__(self, filename):
         """
-        If <cache> is set to True, the whole file is read in at once. 
-        This is usually faster, but may not be possible for very large files.
+        The file is read line by line, so even very large files can be
+        iterated without keeping them in memory.
         """
         self.filename = filename
-        self.file = open(filename,'r')
-        self.cached = cache
-        # Caching is preferred unless the file is too big too keep in memory 
-        if cache:
-            self.contents = self.file.readlines()
-            self.numlines = len(self.contents)
+        self.file = open(filename,'r',_BUF)
         self.reset()
 
     def __iter__(self):
         return self
 
     def next(self):
-        self.lineno += 1
-        if self.cached and self.lineno >= self.numlines:
+        line = self.file.readline()
+        if not line:
             raise StopIteration
-        elif not self.cached:
-            try:
-                return "1 "+self.file.readline()
-            except GeneralError:
-                raise StopIteration
-        else:
-            return "0 "+self.contents[self.lineno]
+        self.lineno += 1
+        return line
 
     def reset(self):
         self.lineno = -1
-        if not self.cached:
-            self.file.seek(0)
+        self.file.seek(0)
+
+
+# All the per-step quantities extracted by OutcarParser.get_ionic_steps,
+# fused into a single alternation so each OUTCAR line is scanned once
+# instead of once per pattern. The branch that matched is identified
+# through match.lastgroup.
+_OUTCAR_STEP_LINE = re.compile(
+    r'Iteration[ \t]*(?P<iter>[0-9]+)|'
+    r'FORCES: max atom, RMS[ \t]*(?P<maxatom>[0-9.\-]+)[ \t]*(?P<rms>[0-9.\-]+)|'
+    r'% ion-electron   TOTEN[ \t]*=[ \t]*(?P<ion_electron>[0-9.\-]+)|'
+    r'kinetic Energy EKIN[ \t]*=[ \t]*(?P<ion_kinetic>[0-9.\-]+)|'
+    r'total energy   ETOTAL[ \t]*=[ \t]*(?P<total>[0-9.\-E]+)')
+
+# Patterns probed against every line by OutcarParser.readItAll,
+# precompiled as bytes patterns since readItAll reads OUTCAR through a
+# read-only memory map.
+_OUTCAR_KPOINTS = re.compile(br'(\d+) +irreducible')
+_OUTCAR_TOTEN = re.compile(br'free  energy   TOTEN  = +(-*\d+.\d+)')
+_OUTCAR_CPUTIME = re.compile(br'Total CPU time used \(sec\): +(\d+.\d+)')
+_OUTCAR_CARTESIAN = re.compile(br'Following cartesian coordinates:')
+_OUTCAR_NPLWV = re.compile(br'NPLWV[ \t]*=[ \t]*([0-9])')
+_OUTCAR_PRESSURE = re.compile(br'external pressure')
+_OUTCAR_TOTAL_FORCE = re.compile(br'TOTAL\-FORCE')
+_OUTCAR_DASHES = re.compile(br'----')
 
 
 class OutcarParser(object):
     """
     Parser for OUTCAR files
     """
-    
+
     def __str(self):
         return "OUTCAR parser"
 
@@ -751,34 +928,37 @@ class OutcarParser(object):
 
         self.filename = outcarname
         self.file = FileIterator(self.filename)
-        self.selective_dynamics = selective_dynamics 
-        
-        # Read the first lines to find the following parameters:
+        self.selective_dynamics = selective_dynamics
+        # Boolean (natoms,3) mask of mobile degrees of freedom, prepared
+        # once here so the per-step force reduction in readItAll does not
+        # have to convert it for every ionic step.
+        if np.any(selective_dynamics):
+            self._sd_mask = np.asarray(selective_dynamics, dtype=bool)
+        else:
+            self._sd_mask = None
+
+        # Read the first lines to find the following parameters.
+        # All the keys are fused into one alternation, so each header line
+        # is scanned once instead of once per key.
         config = { 'IBRION': 0, 'NSW': 0, 'POTIM': 0., 'TEIN': 0., 'TEBEG': 0., 'TEEND': 0., 'SMASS': 0. }
-        config_patterns = {}
-        keys_found = {}
-        for key in config.keys():
-            keys_found[key] = False
-            config_patterns[key] = re.compile(key+'[ \t]*=[ \t]*([0-9.\-]+)')
+        header_pattern = re.compile('(?P<key>'+'|'.join(config.keys())+')[ \t]*=[ \t]*(?P<val>[0-9.\-]+)')
+        remaining = set(config.keys())
 
         for line in self.file:
-            allkeys_found = True
-            for key in config.keys():
-                m = config_patterns[key].search(line)
-                if m:
-                    config[key] = float(m.group(1))
-                    keys_found[key] = True
-                if not keys_found[key]:
-                    allkeys_found = False
-            if allkeys_found:
+            # a single line may hold more than one key
+            for m in header_pattern.finditer(line):
+                key = m.group('key')
+                if key in remaining:
+                    config[key] = float(m.group('val'))
+                    remaining.discard(key)
+            if not remaining:
                 break
-        if not allkeys_found:
+        if remaining:
             print "WARNING! Not all config keys were found! Perhaps the OUTCAR format has changed?"
             print "Keys not found:"
-            for key in config.keys():
-                if not keys_found[key]:
-                    print key
-        self.config = config 
+            for key in remaining:
+                print key
+        self.config = config
 
         #print (self.file.lineno+1),"lines read"
         self.file.reset()
@@ -813,51 +993,48 @@ class OutcarParser(object):
             a['time'] *= self.config['POTIM']
 
         for line in self.file:
-            
-            m = re.search('Iteration[ \t]*([0-9]+)', line)
-            if m: 
-                stepno = int(m.group(1))
-                
-            m = re.search('FORCES: max atom, RMS[ \t]*([0-9.\-]+)[ \t]*([0-9.\-]+)', line)
-            if m: 
-                a['forces']['max_atom'][stepno-1] = float(m.group(1))
-                a['forces']['rms'][stepno-1] = float(m.group(2))
-
-            m = re.search('% ion-electron   TOTEN[ \t]*=[ \t]*([0-9.\-]+)', line)
-            if m: 
-                a['energy']['ion_electron'][stepno-1] = float(m.group(1))
-
-            m = re.search('kinetic Energy EKIN[ \t]*=[ \t]*([0-9.\-]+)', line)
-            if m: 
-                a['energy']['ion_kinetic'][stepno-1] = float(m.group(1))
-            
-            m = re.search('total energy   ETOTAL[ \t]*=[ \t]*([0-9.\-E]+)', line)
-            if m: 
-                a['energy']['total'][stepno-1] = float(m.group(1))
+
+            m = _OUTCAR_STEP_LINE.search(line)
+            if not m:
+                continue
+            kind = m.lastgroup
+            if kind == 'iter':
+                stepno = int(m.group('iter'))
+            elif kind == 'rms':
+                a['forces']['max_atom'][stepno-1] = float(m.group('maxatom'))
+                a['forces']['rms'][stepno-1] = float(m.group('rms'))
+            elif kind == 'ion_electron':
+                a['energy']['ion_electron'][stepno-1] = float(m.group('ion_electron'))
+            elif kind == 'ion_kinetic':
+                a['energy']['ion_kinetic'][stepno-1] = float(m.group('ion_kinetic'))
+            elif kind == 'total':
+                a['energy']['total'][stepno-1] = float(m.group('total'))
 
             #m = re.search('maximum distance moved by ions[ \t]*:[ \t]*([0-9.\-E]+)', line)
-            #if m: 
+            #if m:
             #    a['energy']['total'][stepno-1] = float(m.group(1))
 
         return a
 
 
     def readItAll(self):
-        outfile = open(self.filename)
-        while 1:
-            line = outfile.readline()
-            kmatch = re.search('(\d+) +irreducible', line)
-            ematch = re.search('free  energy   TOTEN  = +(-*\d+.\d+)', line)
-            cpumatch = re.search('Total CPU time used \(sec\): +(\d+.\d+)', line)
-            distmatch = re.search('Following cartesian coordinates:', line)
+        # Scan the file through a read-only memory map. Lines come out as
+        # cheap bytes objects, and sequential access lets the OS prefetch
+        # optimally.
+        fh = open(self.filename, 'rb')
+        mm = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+        for line in iter(mm.readline, b''):
+            kmatch = _OUTCAR_KPOINTS.search(line)
+            ematch = _OUTCAR_TOTEN.search(line)
+            cpumatch = _OUTCAR_CPUTIME.search(line)
+            distmatch = _OUTCAR_CARTESIAN.search(line)
 
             #k-points           NKPTS =      1   k-points in BZ     NKDIM =      1   number of bands    NBANDS=     96
             #number of dos      NEDOS =    301   number of ions     NIONS =      8
             #non local maximal  LDIM  =      4   non local SUM 2l+1 LMDIM =      8
             #total plane-waves  NPLWV =  32768
 
-            planewavematch = re.search('NPLWV[ \t]*=[ \t]*([0-9])', line)
-            nbandsmatch = re.search('NPLWV[ \t]*=[ \t]*([0-9])', line)
+            planewavematch = _OUTCAR_NPLWV.search(line)
             if planewavematch:
                 self.planewaves = int(planewavematch.group(1))
             if kmatch:
@@ -868,61 +1045,45 @@ class OutcarParser(object):
                 self.cpu = float(cpumatch.group(1))
             elif distmatch:
                 if self.kpoints > 1:
-                    tmpline = outfile.readline()
-                    firstline = outfile.readline()
-                    secondline = outfile.readline()
+                    tmpline = mm.readline()
+                    firstline = mm.readline()
+                    secondline = mm.readline()
                     k1x,k1y,k1z,dummy = map(float, firstline.split())
                     k2x,k2y,k2z,dummy = map(float, secondline.split())
                     self.dist = math.sqrt((k2x-k1x)*(k2x-k1x)+(k2y-k1y)*(k2y-k1y)+(k2z-k1z)*(k2z-k1z))
                 else:
                     self.dist = 0
-            elif re.search(r'external pressure', line): 
+            elif _OUTCAR_PRESSURE.search(line):
                 tmp,tmp,tmp,pressure,tmp,tmp,tmp,tmp,tmp,tmp = line.split()
                 self.maxpressure = float(pressure)
-            elif re.search(r'TOTAL\-FORCE', line):
-                i=0
-                line = outfile.readline()
-                maxdrift = 0.0
-                maxforce = 0.0
+            elif _OUTCAR_TOTAL_FORCE.search(line):
+                # Accumulate the whole position/force block and parse it
+                # with numpy in one go. Python is only used to find the
+                # block delimiter.
+                mm.readline() # skip the '----' line below the header
+                block = []
                 while 1:
-                    line = outfile.readline()
-                    if re.search(r'----', line):
-                        line = outfile.readline()
-                        a,b,driftx,drifty,driftz = line.split()
-                        if abs(float(driftx)) > maxdrift:
-                            maxdrift = abs(float(driftx))
-                        if abs(float(drifty)) > maxdrift:
-                            maxdrift = abs(float(drifty))
-                        if abs(float(driftz)) > maxdrift:
-                            maxdrift = abs(float(driftz))
+                    line = mm.readline()
+                    if not line or _OUTCAR_DASHES.search(line):
                         break
-                    posx,posy,posz,forx,fory,forz = map(float, line.split())
-                    if self.selective_dynamics:
-                        if (abs(forx) > maxforce) and (x[i] == 'T' or x[i] == 't'):
-                            maxforce = abs(forx)
-                            maxi = i
-                        if (abs(fory) > maxforce) and (y[i] == 'T' or y[i] == 't'):
-                            maxforce = abs(fory)
-                            maxi = i
-                        if (abs(forz) > maxforce) and (z[i] == 'T' or z[i] == 't'):
-                            maxforce = abs(forz)
-                            maxi = i
-                    else:
-                        if abs(forx) > maxforce:
-                            maxforce = abs(forx)
-                            maxi = i
-                        if abs(fory) > maxforce:
-                            maxforce = abs(fory)
-                            maxi = i
-                        if abs(forz) > maxforce:
-                            maxforce = abs(forz)
-                            maxi = i
-                        i = i+1
+                    block.append(line)
+                maxdrift = 0.0
+                maxforce = 0.0
+                if block:
+                    arr = np.fromstring(b''.join(block), sep=' ').reshape(-1, 6)
+                    absfor = np.abs(arr[:,3:6])
+                    if self._sd_mask is not None:
+                        # ignore forces on fixed degrees of freedom
+                        absfor = np.where(self._sd_mask, absfor, 0.0)
+                    maxforce = float(absfor.max())
+                if line:
+                    # drift line: "total drift:  x y z"
+                    drift = mm.readline().split()
+                    maxdrift = max(abs(float(drift[2])), abs(float(drift[3])), abs(float(drift[4])))
                 self.maxforce = maxforce
                 self.maxdrift = maxdrift
-            if not line:
-                break
-        outfile.close()
+        mm.close()
+        fh.close()
 
     def get_max_drift(self):
         return self.maxdrift
@@ -940,13 +1101,14 @@ class OutcarParser(object):
         return self.cpu
 
     def get_incar_property(self, propname):
-        outfile = open(self.filename, 'r')
-        lines = outfile.readlines()
+        outfile = open(self.filename, 'r', _BUF)
         s = re.compile('[\t ]*'+propname+'[\t ]*=[\t ]*([0-9.]*)')
-        for l in lines:
+        for l in outfile:
             res = s.match(l)
             if res:
+                outfile.close()
                 return res.group(1)
+        outfile.close()
 
         print "Failed to lookup INCAR property "+propname+" in "+self.filename
         sys.exit(1)
@@ -975,7 +1137,7 @@ class PoscarParser(object):
             self.filename = poscar.name
         else:
             self.filename = poscar 
-            self._file = open( self.filename, 'r')
+            self._file = open( self.filename, 'r', _BUF)
         self._parse(silent)
 
     def strip_comments(self, line):
@@ -993,10 +1155,7 @@ class PoscarParser(object):
         vec1line = self.strip_comments(poscarfile.readline())
         vec2line = self.strip_comments(poscarfile.readline())
         vec3line = self.strip_comments(poscarfile.readline())
-        self.basis = np.zeros((3,3))
-        self.basis[0] = map(float,vec1line.split())
-        self.basis[1] = map(float,vec2line.split())
-        self.basis[2] = map(float,vec3line.split())
+        self.basis = np.fromstring(vec1line + vec2line + vec3line, sep=' ').reshape(3,3)
         self.basis *= self.scale_factor
         
         # Read the atom counts line
@@ -1030,13 +1189,20 @@ class PoscarParser(object):
         if line[0].upper() == 'D':
             self.direct_coords = True
 
-        # Atomic positions
-        self.positions = np.zeros((self.natoms,3))
+        # Atomic positions. The coordinate block is collected and handed
+        # to numpy in one go instead of being parsed row by row in Python.
+        lines = []
         for j in range(self.natoms):
-            line = self.strip_comments(poscarfile.readline())
-            self.positions[j] = [float(x) for x in (line.split()[0:3])]
-            if len(self.positions[j]) != 3:
+            line = poscarfile.readline()
+            if line == '':
                 raise IOError('POSCAR file %s ended before all coordinates were read in' % self.filename)
+            lines.append(self.strip_comments(line))
+        if self.selective_dynamics:
+            # the coordinate columns are followed by T/F flags,
+            # so only the first three columns of each line are numeric
+            self.positions = np.array([l.split()[0:3] for l in lines], dtype=float)
+        else:
+            self.positions = np.fromstring(''.join(lines), sep=' ', count=self.natoms*3).reshape(self.natoms,3)
         
         poscarfile.close()
         